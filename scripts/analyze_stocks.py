@@ -1,23 +1,168 @@
 import os
+import re
+import functools
+import glob
+import itertools
 import json
+import random
+import string
 import time
-from datetime import datetime
-from dashscope import Generation
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, time as dt_time
+from pathlib import Path
+from zoneinfo import ZoneInfo
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import akshare as ak
+import numpy as np
 import pandas as pd
 
+try:
+    import orjson
+except ImportError:  # 未安装 orjson 时退回标准库 json
+    orjson = None
+
+try:
+    from .indicators import calculate_rsi_rows
+except ImportError:  # 以 python scripts/analyze_stocks.py 直接运行时没有父包
+    from indicators import calculate_rsi_rows
+
 # 配置 Qwen3 API
 DASHSCOPE_API_KEY = os.getenv("DASHSCOPE_API_KEY")
-Generation.api_key = DASHSCOPE_API_KEY
 
-def load_stock_list():
-    with open("STOCKS.txt", "r", encoding="utf-8") as f:
-        stocks = [line.strip() for line in f if line.strip() and not line.startswith("#")]
-    return stocks
+# 并发配置：行情与 AI 分析均为网络 I/O，多线程可重叠等待时间
+MAX_WORKERS = int(os.getenv("STOCK_WORKERS", "8"))
+# 限制同时进行的 akshare 请求数，线程再多也不会对行情接口突发过量请求
+_AKSHARE_SEMAPHORE = threading.Semaphore(4)
+# 每次 Qwen 请求合并分析的股票数（每只约 250 tokens，总输出需低于模型上限）
+BATCH_SIZE = 8
+# AI 分析线程数
+LLM_WORKERS = int(os.getenv("QWEN_WORKERS", "2"))
+# Qwen 请求速率上限（次/秒）与突发容量，由全部线程共享的令牌桶控制
+QWEN_QPS = float(os.getenv("QWEN_QPS", "5"))
+QWEN_BURST = 10
+
+# 本地磁盘缓存：日线在同一交易日内不变，重复运行无需再次下载
+CACHE_DIR = "cache"
+_MARKET_TZ = ZoneInfo("Asia/Shanghai")
+# 已完成分析的结果按 (代码, 最新交易日) 缓存，同日重跑时跳过行情计算与 AI 分析
+RESULT_CACHE_DIR = os.path.join(CACHE_DIR, "results")
+# 股票名称极少变化，磁盘缓存 7 天
+NAME_CACHE_PATH = os.path.join(CACHE_DIR, "names.json")
+NAME_CACHE_TTL = 7 * 86400
+# 全市场 {代码: 简称} 表，与单只名称共用 7 天有效期
+NAME_MAP_PATH = os.path.join(CACHE_DIR, "name_map.json")
+_NAME_CACHE_LOCK = threading.Lock()
+# 日线回溯天数：约 80 个交易日，足够 MA20 与 Wilder RSI 收敛，远小于全量历史
+HISTORY_DAYS = 120
+# A 股 15:00 收盘，留出数据落地时间后视为当日日线定型
+_MARKET_SETTLED = dt_time(15, 30)
+
+# 共享 HTTP 会话：akshare 内部直接调用 requests.get，替换后各线程复用 TCP/TLS 连接
+# 连接池需不小于并发线程数，否则多余连接会被丢弃、无法保持长连接
+_SESSION = requests.Session()
+_HTTP_ADAPTER = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False),
+)
+_SESSION.mount("https://", _HTTP_ADAPTER)
+_SESSION.mount("http://", _HTTP_ADAPTER)
+requests.get = _SESSION.get
+
+@functools.cache
+def load_stock_list(path="STOCKS.txt"):
+    """
+    读取股票列表（忽略空行与 # 注释），同一进程内只读一次文件
+    """
+    lines = Path(path).read_text(encoding="utf-8").splitlines()
+    return tuple(line.strip() for line in lines if line.strip() and not line.startswith("#"))
+
+# 公司全称后缀，一次匹配完成清理；"集团股份有限公司" 只去掉 "股份有限公司"，保留 "集团"
+_COMPANY_SUFFIX_RE = re.compile(r"(?:股份|集团)?有限公司$")
+
+_NAME_CACHE = None
+
+def _name_cache():
+    """
+    名称缓存 {代码: {"name": 名称, "ts": 写入时间}}，首次使用时从磁盘加载；
+    加载在锁内完成，多个线程同时首次调用也只得到同一个字典
+    """
+    global _NAME_CACHE
+    with _NAME_CACHE_LOCK:
+        if _NAME_CACHE is None:
+            try:
+                with open(NAME_CACHE_PATH, "r", encoding="utf-8") as f:
+                    _NAME_CACHE = json.load(f)
+            except (OSError, ValueError):
+                _NAME_CACHE = {}
+        return _NAME_CACHE
+
+def cached_name(func):
+    """
+    名称查询的磁盘缓存：TTL 内直接返回缓存，未命中时调用原函数并写回内存缓存
+    """
+    @functools.wraps(func)
+    def wrapper(symbol):
+        cache = _name_cache()
+        entry = cache.get(symbol)
+        if entry and time.time() - entry["ts"] < NAME_CACHE_TTL:
+            return entry["name"]
+        name = func(symbol)
+        if name:
+            with _NAME_CACHE_LOCK:
+                cache[symbol] = {"name": name, "ts": time.time()}
+        return name
+    return wrapper
+
+def save_name_cache():
+    """
+    将名称缓存原子写回磁盘（先写临时文件再替换）
+    """
+    cache = _name_cache()
+    with _NAME_CACHE_LOCK:
+        data = dict(cache)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = f"{NAME_CACHE_PATH}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, NAME_CACHE_PATH)
+
+def load_name_map():
+    """
+    一次请求获取全部 A 股 {代码: 简称}，替代逐只查询；结果缓存到 cache/ 目录，有效期内不再下载。
+    失败返回空字典
+    """
+    try:
+        if time.time() - os.path.getmtime(NAME_MAP_PATH) < NAME_CACHE_TTL:
+            with open(NAME_MAP_PATH, "r", encoding="utf-8") as f:
+                return json.load(f)
+    except (OSError, ValueError):
+        pass
 
+    try:
+        df = ak.stock_info_a_code_name()
+        name_map = dict(zip(df['code'].astype(str).str.zfill(6), df['name'].astype(str).str.strip()))
+    except Exception as e:
+        print(f"⚠️ 股票名称列表获取失败，改为逐只查询: {e}")
+        return {}
+    if name_map:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = f"{NAME_MAP_PATH}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(name_map, f, ensure_ascii=False)
+        os.replace(tmp, NAME_MAP_PATH)
+    return name_map
+
+@functools.lru_cache(maxsize=4096)
+@cached_name
 def get_stock_name_safe(symbol):
     """
-    安全获取单只股票名称，确保无缓存污染
+    安全获取单只股票名称，仅用于批量名称表中没有的代码；结果经进程内 lru_cache 与
+    7 天磁盘缓存（cached_name），查询失败返回 None，不写入磁盘缓存
     """
     try:
         # 明确指定市场
@@ -28,220 +173,625 @@ def get_stock_name_safe(symbol):
         else:
             return None
 
-        # ⚠️ 关键：每次调用前清除可能的内部缓存（通过新进程模拟，此处用重试+延迟）
-        time.sleep(0.1)  # 防止请求过快被限
-        
-        df = ak.stock_individual_info_em(symbol=symbol, market=market)
+        # 限流由 akshare 并发信号量与会话级失败重试负责，不再每次固定等待
+        with _AKSHARE_SEMAPHORE:
+            df = ak.stock_individual_info_em(symbol=symbol, market=market)
         
         if df is not None and not df.empty:
             # 查找“公司全称”或“股票简称”
             if 'item' in df.columns and 'value' in df.columns:
+                # item/value 两列直接转为字典，避免逐项布尔筛选与 iloc 行对象构造
+                info = dict(zip(df['item'].to_numpy(), df['value'].to_numpy()))
+
                 # 尝试获取股票简称（更短）
-                short_name_row = df[df['item'] == '股票简称']
-                if not short_name_row.empty:
-                    name = str(short_name_row.iloc[0]['value']).strip()
+                if '股票简称' in info:
+                    name = str(info['股票简称']).strip()
                     return name
-                
+
                 # 否则用公司全称
-                full_name_row = df[df['item'] == '公司全称']
-                if not full_name_row.empty:
-                    name = str(full_name_row.iloc[0]['value']).strip()
+                if '公司全称' in info:
+                    name = str(info['公司全称']).strip()
                     # 清理后缀
-                    for suffix in ["股份有限公司", "集团股份有限公司", "集团有限公司", "有限公司"]:
-                        if name.endswith(suffix):
-                            name = name[:-len(suffix)].rstrip()
-                            break
+                    name = _COMPANY_SUFFIX_RE.sub("", name, count=1).rstrip()
                     return name
         return None
     except Exception as e:
         # print(f"  调试: {symbol} 名称获取失败 - {e}")
         return None
 
-STOCKS = load_stock_list()
+# ========== 行情获取与缓存、指标计算、AI 分析 ==========
 
-# ========== 以下保持不变（仅在 main 中调用 get_stock_name_safe） ==========
+def _market_now():
+    return datetime.now(_MARKET_TZ)
 
-def calculate_rsi(prices, window=14):
-    delta = prices.diff()
-    gain = (delta.where(delta > 0, 0)).rolling(window=window).mean()
-    loss = (-delta.where(delta < 0, 0)).rolling(window=window).mean()
-    rs = gain / loss
-    rsi = 100 - (100 / (1 + rs))
-    return rsi.iloc[-1]
+def _cache_is_fresh(path):
+    """
+    收盘前写入的缓存只在收盘前有效；收盘后写入的缓存当日内一直有效
+    """
+    if not os.path.exists(path):
+        return False
+    now = _market_now()
+    settled_at = datetime.combine(now.date(), _MARKET_SETTLED, tzinfo=_MARKET_TZ)
+    written_at = datetime.fromtimestamp(os.path.getmtime(path), _MARKET_TZ)
+    return now < settled_at or written_at >= settled_at
+
+def fetch_hist(symbol):
+    """
+    获取日线行情，按 (symbol, 交易日) 缓存到 cache/ 目录，旧日期的缓存在写入时清理
+    """
+    path = os.path.join(CACHE_DIR, f"{symbol}_{_market_now():%Y%m%d}.pkl")
+    if _cache_is_fresh(path):
+        try:
+            return pd.read_pickle(path)
+        except Exception:
+            pass
 
-def get_stock_data(symbol):
-    try:
+    with _AKSHARE_SEMAPHORE:
         df = ak.stock_zh_a_hist(
             symbol=symbol,
             period="daily",
-            start_date="20240101",
+            start_date=f"{_market_now() - timedelta(days=HISTORY_DAYS):%Y%m%d}",
             adjust="qfq"
         )
-        if df.empty or len(df) < 5:
-            return None
+    if df is not None and not df.empty:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        for old in glob.glob(os.path.join(CACHE_DIR, f"{symbol}_*.pkl")):
+            if old != path:
+                os.remove(old)
+        tmp = f"{path}.tmp"
+        df.to_pickle(tmp)
+        os.replace(tmp, path)
+    return df
+
+def _json_safe(obj):
+    """
+    转为标准库 json 可序列化的纯 Python 对象：numpy 类型转原生类型，NaN/Infinity 转 None，
+    与 orjson 输出 null 一致（前端 response.json() 无法解析裸 NaN）
+    """
+    if isinstance(obj, dict):
+        return {key: _json_safe(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple, np.ndarray)):
+        return [_json_safe(value) for value in obj]
+    if isinstance(obj, np.generic):
+        obj = obj.item()
+    if isinstance(obj, float) and not np.isfinite(obj):
+        return None
+    return obj
+
+def _json_dumps(obj):
+    """
+    序列化为 UTF-8 字节：优先用 orjson（原生 UTF-8、直接支持 numpy），未安装时退回标准库 json
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(_json_safe(obj), ensure_ascii=False, allow_nan=False).encode("utf-8")
+
+def _json_loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+def _result_cache_path(symbol, trade_date):
+    return os.path.join(RESULT_CACHE_DIR, f"{symbol}-{trade_date}.json")
+
+def _result_is_settled(path, trade_date):
+    """
+    结果缓存按其交易日判断有效期：该交易日 15:30 之后写入的一直有效；
+    之前写入的（盘中数据）只在该交易日收盘前有效，之后（含周末、次日盘前）需重新分析
+    """
+    if not os.path.exists(path):
+        return False
+    settled_at = datetime.combine(datetime.strptime(trade_date, "%Y%m%d").date(), _MARKET_SETTLED, tzinfo=_MARKET_TZ)
+    written_at = datetime.fromtimestamp(os.path.getmtime(path), _MARKET_TZ)
+    now = _market_now()
+    return written_at >= settled_at or (now.date() == settled_at.date() and now < settled_at)
+
+def load_cached_result(symbol, trade_date):
+    """
+    读取 (symbol, 交易日) 的已完成分析结果；不存在、已过期或损坏时返回 None
+    """
+    path = _result_cache_path(symbol, trade_date)
+    if not _result_is_settled(path, trade_date):
+        return None
+    try:
+        with open(path, "rb") as f:
+            return _json_loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+def save_cached_result(record, trade_date):
+    """
+    缓存分析成功的结果，同时清理该股票旧交易日的缓存；分析失败的结果不缓存，下次重跑时重试
+    """
+    analysis = record.get("analysis", "")
+    if not trade_date or analysis == "分析失败" or analysis.startswith("API错误"):
+        return
+    symbol = record["symbol"]
+    path = _result_cache_path(symbol, trade_date)
+    os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+    for old in glob.glob(_result_cache_path(symbol, "*")):
+        if old != path:
+            os.remove(old)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(_json_dumps(record))
+    os.replace(tmp, path)
+
+# 主力行为信号文案，下标与 _main_force_cascade 的分支一一对应
+_MAIN_FORCE_SIGNALS = (
+    "数据不足",
+    "强势拉升（放量突破新高）",
+    "低位吸筹（横盘缩量）",
+    "健康洗盘（回调缩量后回升）",
+    "放量下跌（警惕派发风险）",
+    "放量上涨（主力积极介入）",
+    "温和推升（惜售明显）",
+    "震荡整理（方向待明）",
+)
+
+def _main_force_cascade(bits):
+    """
+    按主力行为判断的 if/elif 优先级，把各条件位映射为 _MAIN_FORCE_SIGNALS 下标
+    """
+    (valid, up_5d, high_vol, new_high, flat_5d, vol_min, pullback, pullback_low_vol,
+     above_3d, down_1d, drop_3pct, up_1d, above_ma20, vol_shrink, price_up) = bits
+    return np.select(
+        [
+            ~valid,
+            up_5d & high_vol & new_high,
+            flat_5d & vol_min,
+            pullback & pullback_low_vol & above_3d,
+            down_1d & high_vol & drop_3pct,
+            up_1d & high_vol,
+            above_ma20 & vol_shrink & price_up,
+        ],
+        [0, 1, 2, 3, 4, 5, 6],
+        default=7,
+    )
+
+# 15 个条件位打包为整数键，导入时一次性生成全部组合的结果表，之后只需查表
+_MAIN_FORCE_BITS = 15
+_keys = np.arange(1 << _MAIN_FORCE_BITS)
+_MAIN_FORCE_TABLE = _main_force_cascade(
+    [(_keys >> i) & 1 == 1 for i in range(_MAIN_FORCE_BITS)]
+).astype(np.int8)
+del _keys
+
+def _main_force_codes(closes, vols, lengths, ma20, price_up):
+    """
+    基于每行近5日收盘价/成交量推断主力行为，返回 _MAIN_FORCE_SIGNALS 下标数组
+    """
+    c = closes[:, -5:]
+    v = vols[:, -5:]
+    latest, prev, prev2 = c[:, -1], c[:, -2], c[:, -3]
+    latest_vol = v[:, -1]
+    avg_vol_5d = v.mean(axis=1)
+    high_vol = latest_vol > avg_vol_5d * 1.5
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pct_5d = np.where(c[:, 0] != 0, (latest - c[:, 0]) / c[:, 0], 0.0)
+        drop_1d = (prev - latest) / prev
+
+    bits = (
+        lengths >= 5,
+        pct_5d > 0.05,
+        high_vol,
+        latest == c.max(axis=1),
+        np.abs(pct_5d) < 0.02,
+        latest_vol == v.min(axis=1),
+        (prev < prev2) & (latest > prev),
+        v[:, -2] < avg_vol_5d * 0.7,
+        latest > prev2,
+        latest < prev,
+        drop_1d > 0.03,
+        latest > prev,
+        latest > ma20,
+        latest_vol < avg_vol_5d * 0.8,
+        price_up,
+    )
+    key = np.zeros(len(lengths), dtype=np.int64)
+    for i, bit in enumerate(bits):
+        key |= bit.astype(np.int64) << i
+    return _MAIN_FORCE_TABLE[key]
+
+# 量价关系文案，下标与 compute_features 中 np.select 的分支一一对应
+_VOLUME_PRICE_SIGNALS = (
+    "价涨量增（趋势健康）",
+    "价跌量缩（抛压减轻）",
+    "缩量上涨（持续性存疑）",
+    "放量下跌（主力出货或洗盘）",
+    "量价中性",
+)
+
+def _column_array(df, col):
+    """
+    取出一列为数值数组并保留原始 dtype（成交量通常为 int64）；akshare 通常已返回数值列，
+    仅在类型异常时才做逐元素转换
+    """
+    series = df[col]
+    if not np.issubdtype(series.dtype, np.number):
+        series = pd.to_numeric(series, errors='coerce')
+    return series.to_numpy()
 
-        df.rename(columns={
-            '日期': 'date',
-            '开盘': 'open',
-            '收盘': 'close',
-            '最高': 'high',
-            '最低': 'low',
-            '成交量': 'volume'
-        }, inplace=True)
-
-        df['close'] = pd.to_numeric(df['close'], errors='coerce')
-        df['volume'] = pd.to_numeric(df['volume'], errors='coerce')
-        df.dropna(subset=['close', 'volume'], inplace=True)
-        df.reset_index(drop=True, inplace=True)
-
-        if len(df) < 2:
+def load_series(symbol):
+    """
+    获取并清洗单只股票日线，返回 (收盘价, 成交量, 最新交易日 YYYYMMDD)，收盘价为 float64 数组，
+    成交量保留原始整型（仅在需要剔除缺失值时为 float64）；
+    数据不足返回 None
+    """
+    try:
+        df = fetch_hist(symbol)
+        if df is None or df.empty or len(df) < 5:
             return None
 
-        latest = df.iloc[-1]
-        prev = df.iloc[-2]
-        close_prices = df['close']
-        volumes = df['volume']
-
-        change_pct = ((latest['close'] - prev['close']) / prev['close']) * 100
-        rsi = calculate_rsi(close_prices) if len(close_prices) >= 14 else "N/A"
-        ma20 = close_prices.tail(20).mean() if len(close_prices) >= 20 else "N/A"
-
-        price_up = latest['close'] > prev['close']
-        vol_up = latest['volume'] > prev['volume']
-
-        if price_up and vol_up:
-            volume_price_signal = "价涨量增（趋势健康）"
-        elif not price_up and latest['volume'] < prev['volume']:
-            volume_price_signal = "价跌量缩（抛压减轻）"
-        elif price_up and not vol_up:
-            volume_price_signal = "缩量上涨（持续性存疑）"
-        elif not price_up and vol_up:
-            volume_price_signal = "放量下跌（主力出货或洗盘）"
-        else:
-            volume_price_signal = "量价中性"
-
-        def infer_main_force_behavior(df):
-            closes = df['close'].tail(5).tolist()
-            vols = df['volume'].tail(5).tolist()
-            if len(closes) < 5:
-                return "数据不足"
-            
-            latest_close = closes[-1]
-            latest_vol = vols[-1]
-            avg_vol_5d = sum(vols) / 5
-            high_vol = latest_vol > avg_vol_5d * 1.5
-
-            pct_5d = (latest_close - closes[0]) / closes[0] if closes[0] != 0 else 0
-            is_new_high = latest_close == max(closes)
-            recent_pullback = len(closes) >= 3 and closes[-2] < closes[-3] and latest_close > closes[-2]
-            pullback_low_vol = len(vols) >= 2 and vols[-2] < avg_vol_5d * 0.7
-
-            if pct_5d > 0.05 and high_vol and is_new_high:
-                return "强势拉升（放量突破新高）"
-            elif abs(pct_5d) < 0.02 and latest_vol == min(vols):
-                return "低位吸筹（横盘缩量）"
-            elif recent_pullback and pullback_low_vol and latest_close > closes[-3]:
-                return "健康洗盘（回调缩量后回升）"
-            elif latest_close < closes[-2] and high_vol and (closes[-2] - latest_close) / closes[-2] > 0.03:
-                return "放量下跌（警惕派发风险）"
-            elif latest_close > closes[-2] and high_vol:
-                return "放量上涨（主力积极介入）"
-            elif latest_close > ma20 and latest_vol < avg_vol_5d * 0.8 and price_up:
-                return "温和推升（惜售明显）"
-            else:
-                return "震荡整理（方向待明）"
-
-        main_force_signal = infer_main_force_behavior(df)
+        # 只用到收盘价与成交量，直接取出为数组，后续全部在 ndarray 上计算
+        close = _column_array(df, '收盘').astype(np.float64, copy=False)
+        volume = _column_array(df, '成交量')
+        mask = np.isfinite(close) & np.isfinite(volume)
+        if not mask.all():
+            close = close[mask]
+            volume = volume[mask]
 
-        return {
-            "symbol": symbol,
-            "price": round(latest['close'], 2),
-            "change_pct": round(change_pct, 2),
-            "volume": int(latest['volume']),
-            "rsi": round(rsi, 2) if isinstance(rsi, float) else rsi,
-            "ma20": round(ma20, 2) if isinstance(ma20, float) else ma20,
-            "last_5_days": close_prices.tail(5).round(2).tolist(),
-            "volume_price_signal": volume_price_signal,
-            "main_force_signal": main_force_signal,
-        }
+        if len(close) < 2:
+            return None
+        trade_date = f"{pd.Timestamp(df['日期'].iloc[-1]):%Y%m%d}" if '日期' in df.columns else None
+        return close, volume, trade_date
 
     except Exception:
         return None
 
-def generate_analysis(data):
-    stock_display = f"{data['name']}（{data['symbol']}）" if data.get('name') and data['name'] != "未知名称" else data['symbol']
-    prompt = f"""
+def compute_features(symbols, series):
+    """
+    将各股票日线按最后一个交易日右对齐堆叠为 (股票数, 天数) 矩阵，一次性计算全部指标。
+    series 与 symbols 一一对应；返回 data 字典列表
+    """
+    if not symbols:
+        return []
+
+    lengths = np.array([len(close) for close, _ in series], dtype=np.int64)
+    # 至少 5 列：主力信号等按固定窗口取最近几日，短历史行以 NaN 补齐，由有效位判为数据不足
+    width = max(int(lengths.max()), 5)
+    closes = np.full((len(series), width), np.nan)
+    vols = np.full((len(series), width), np.nan)
+    for row, (close, volume) in enumerate(series):
+        closes[row, width - len(close):] = close
+        vols[row, width - len(volume):] = volume
+
+    latest_close, prev_close = closes[:, -1], closes[:, -2]
+    latest_vol, prev_vol = vols[:, -1], vols[:, -2]
+    change_pct = (latest_close - prev_close) / prev_close * 100
+    ma20 = np.where(lengths >= 20, closes[:, -20:].mean(axis=1), np.nan)
+    rsi = calculate_rsi_rows(closes, lengths, 14)
+
+    price_up = latest_close > prev_close
+    vol_up = latest_vol > prev_vol
+    vp_codes = np.select(
+        [price_up & vol_up, ~price_up & (latest_vol < prev_vol), price_up & ~vol_up, ~price_up & vol_up],
+        [0, 1, 2, 3],
+        default=4,
+    )
+    mf_codes = _main_force_codes(closes, vols, lengths, ma20, price_up)
+    last_5_days = np.round(closes[:, -5:], 2)
+
+    stocks = []
+    for row, symbol in enumerate(symbols):
+        stocks.append({
+            "symbol": symbol,
+            "price": round(float(latest_close[row]), 2),
+            "change_pct": round(float(change_pct[row]), 2),
+            # 成交量直接取原始数组末元素，不经过 NaN 填充的 float64 矩阵
+            "volume": int(series[row][1][-1]),
+            "rsi": round(float(rsi[row]), 2) if lengths[row] > 14 else "N/A",
+            "ma20": round(float(ma20[row]), 2) if lengths[row] >= 20 else "N/A",
+            "last_5_days": last_5_days[row, 5 - min(lengths[row], 5):].tolist(),
+            "volume_price_signal": _VOLUME_PRICE_SIGNALS[vp_codes[row]],
+            "main_force_signal": _MAIN_FORCE_SIGNALS[mf_codes[row]],
+        })
+    return stocks
+
+# 提示词模板在模块加载时构建一次，调用时只替换动态字段
+_ANALYSIS_PROMPT = string.Template("""
 你是一位资深中文股票分析师，请基于以下多维数据生成150字以内简明分析：
 
-- 股票: {stock_display}
-- 当前价格: ¥{data['price']} | 涨跌幅: {data['change_pct']}%
-- 近5日走势: {data['last_5_days']}
-- 量价关系: {data['volume_price_signal']}
-- 主力行为推断: {data['main_force_signal']}
-- RSI: {data['rsi']}（>70超买，<30超卖）
-- 20日均线: {data['ma20']}
+- 股票: $stock_display
+- 当前价格: ¥$price | 涨跌幅: $change_pct%
+- 近5日走势: $last_5_days
+- 量价关系: $volume_price_signal
+- 主力行为推断: $main_force_signal
+- RSI: $rsi（>70超买，<30超卖）
+- 20日均线: $ma20
 
 要求：
 1. 分析中需自然提及股票名称；
 2. 重点结合量价与主力行为判断当前阶段；
 3. 给出具体操作建议；
 4. 语言专业简洁。
-"""
-    for retry in range(3):
+""")
+
+_BATCH_PROMPT = string.Template("""
+你是一位资深中文股票分析师，请基于以下 JSON 数组中每只股票的多维数据，分别生成150字以内简明分析（RSI >70超买，<30超卖）：
+
+$stocks_json
+
+要求：
+1. 分析中需自然提及股票名称；
+2. 重点结合量价与主力行为判断当前阶段；
+3. 给出具体操作建议；
+4. 语言专业简洁；
+5. 只返回 JSON 数组，格式为 [{"symbol": "股票代码", "analysis": "分析内容"}, ...]，不要输出其他内容。
+""")
+
+class TokenBucket:
+    """
+    线程安全的令牌桶：按 rate 个/秒补充令牌，最多积攒 burst 个，只有无令牌时才等待
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._updated:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+                else:
+                    # 处于惩罚期，等到恢复发放令牌
+                    wait = self._updated - now
+            time.sleep(wait)
+
+    def penalize(self, seconds):
+        """
+        收到限流响应后清空令牌并暂停发放 seconds 秒，所有线程一起退避
+        """
+        with self._lock:
+            self._tokens = 0.0
+            self._updated = max(self._updated, time.monotonic() + seconds)
+
+LLM_BUCKET = TokenBucket(rate=QWEN_QPS, burst=QWEN_BURST)
+
+@functools.cache
+def _get_generation():
+    """
+    首次调用 Qwen 时才导入 dashscope 并设置 API Key，仅计算行情指标时不承担其导入开销
+    """
+    from dashscope import Generation
+    if DASHSCOPE_API_KEY:
+        Generation.api_key = DASHSCOPE_API_KEY
+    return Generation
+
+def _call_qwen(prompt, max_tokens, attempts=3):
+    """
+    调用 Qwen，调用前从共享令牌桶取令牌；429 时惩罚令牌桶，异常时指数退避重试。
+    返回最后一次响应，全部异常时返回 None
+    """
+    generation = _get_generation()
+    response = None
+    for retry in range(attempts):
+        LLM_BUCKET.acquire()
         try:
-            response = Generation.call(model="qwen-max", prompt=prompt, max_tokens=250)
-            if response.status_code == 200:
-                return response.output.text.strip()
-            elif response.status_code == 429:
-                time.sleep(2 ** retry)
-                continue
-            else:
-                return f"API错误({response.status_code})"
+            response = generation.call(model="qwen-max", prompt=prompt, max_tokens=max_tokens)
+            if response.status_code != 429:
+                return response
+            LLM_BUCKET.penalize(2 ** retry)
         except Exception:
-            time.sleep(2)
-            continue
-    return "分析失败"
+            response = None
+            if retry < attempts - 1:
+                # 随机抖动避免多个线程同时重试
+                time.sleep(2 ** retry * random.uniform(0.5, 1.5))
+    return response
 
-def main():
-    os.makedirs("output", exist_ok=True)
-    results = []
-    total = len(STOCKS)
-    print(f"🚀 开始分析 {total} 只股票（逐个安全获取名称）...\n")
+def _stock_display(data):
+    return f"{data['name']}（{data['symbol']}）" if data.get('name') and data['name'] != "未知名称" else data['symbol']
 
-    for i, symbol in enumerate(STOCKS, 1):
-        print(f"[{i}/{total}] 正在分析 {symbol}...")
-        try:
-            data = get_stock_data(symbol)
-            if data is None:
-                print(f"  ⚠️ 行情数据失败，跳过 {symbol}")
-                continue
+def generate_analysis(data):
+    stock_display = _stock_display(data)
+    prompt = _ANALYSIS_PROMPT.substitute(data, stock_display=stock_display)
+    response = _call_qwen(prompt, max_tokens=250)
+    if response is None or response.status_code == 429:
+        return "分析失败"
+    if response.status_code != 200:
+        return f"API错误({response.status_code})"
+    try:
+        return response.output.text.strip()
+    except Exception:
+        # 200 响应缺少正文等异常情况按失败处理，不缓存，下次重跑时重试
+        return "分析失败"
 
-            # ✅ 关键：独立、安全地获取名称
-            name = get_stock_name_safe(symbol)
-            data["name"] = name if name else "未知名称"
+def _strip_code_fence(text):
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+        text = text.rsplit("```", 1)[0]
+    return text.strip()
 
-            # 调试输出（可临时开启）
-            print(f"  → 名称: {data['name']}")
+def generate_analysis_batch(data_list):
+    """
+    一次 Qwen 请求分析多只股票，返回 {symbol: analysis}。请求本身失败时每只股票均记为
+    "分析失败"/"API错误(..)"（不缓存，下次重跑时重试）；回复解析异常时返回空字典，由调用方逐只补分析
+    """
+    stocks = [
+        {
+            "symbol": data["symbol"],
+            "股票": _stock_display(data),
+            "当前价格": data["price"],
+            "涨跌幅%": data["change_pct"],
+            "近5日走势": data["last_5_days"],
+            "量价关系": data["volume_price_signal"],
+            "主力行为推断": data["main_force_signal"],
+            "RSI": data["rsi"],
+            "20日均线": data["ma20"],
+        }
+        for data in data_list
+    ]
+    prompt = _BATCH_PROMPT.substitute(stocks_json=json.dumps(stocks, ensure_ascii=False))
+    response = _call_qwen(prompt, max_tokens=250 * len(data_list))
+    if response is None or response.status_code != 200:
+        # 限流或接口错误时不再逐只重试，避免请求数成倍放大
+        failure = "分析失败" if response is None or response.status_code == 429 else f"API错误({response.status_code})"
+        return {data["symbol"]: failure for data in data_list}
+    try:
+        items = json.loads(_strip_code_fence(response.output.text))
+        return {
+            str(item["symbol"]): str(item["analysis"]).strip()
+            for item in items
+            if isinstance(item, dict) and item.get("symbol") and item.get("analysis")
+        }
+    except Exception:
+        return {}
 
-            analysis = generate_analysis(data)
-            data["analysis"] = analysis
-            results.append(data)
+class PredictionWriter:
+    """
+    逐条写入 predictions.json：先写入 .partial 临时文件，每条记录 flush、每 fsync_every 条 fsync；
+    正常结束后原子替换为正式文件，中途异常则保留正式文件不变，已完成部分留在 .partial 中
+    """
 
-            time.sleep(0.3)
+    def __init__(self, path, generated_at, fsync_every=1):
+        self.path = path
+        self.partial_path = f"{path}.partial"
+        self.fsync_every = fsync_every
+        self.count = 0
+        self._f = open(self.partial_path, "wb")
+        self._f.write(b'{"generated_at": ' + _json_dumps(generated_at) + b', "stocks": [\n')
+
+    def write(self, record):
+        if self.count:
+            self._f.write(b",\n")
+        self._f.write(_json_dumps(record))
+        self._f.flush()
+        self.count += 1
+        if self.count % self.fsync_every == 0:
+            os.fsync(self._f.fileno())
+
+    def close(self, commit=True):
+        # 无论是否成功都补齐结尾，.partial 文件始终是合法 JSON
+        self._f.write(b"\n]}\n")
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+        if commit:
+            os.replace(self.partial_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(commit=exc_type is None)
+
+def process_one(symbol, name_map_future):
+    """
+    单只股票数据准备：日线 → 结果缓存 → 名称。名称表在后台并发获取，仅在需要名称时才等待其结果。
+    返回 {"series": (收盘价, 成交量), "trade_date", "name", "cached": 缓存结果或 None}，失败返回 None
+    """
+    loaded = load_series(symbol)
+    if loaded is None:
+        print(f"  ⚠️ 行情数据失败，跳过 {symbol}")
+        return None
+    close, volume, trade_date = loaded
 
-        except Exception as e:
-            print(f"  ❌ 异常: {e}")
-            continue
+    cached = load_cached_result(symbol, trade_date) if trade_date else None
+    if cached is not None:
+        print(f"  → {symbol} 命中当日分析缓存")
+        return {"series": (close, volume), "trade_date": trade_date, "name": cached.get("name"), "cached": cached}
 
-    output = {
-        "generated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "stocks": results
-    }
+    # 优先用批量名称表，表中没有的代码（如指数）再逐只安全查询
+    name = name_map_future.result().get(symbol) or get_stock_name_safe(symbol)
+    name = name if name else "未知名称"
 
-    with open("output/predictions.json", "w", encoding="utf-8") as f:
-        json.dump(output, f, ensure_ascii=False, indent=2)
+    # 调试输出（可临时开启）
+    print(f"  → {symbol} 名称: {name}")
+    return {"series": (close, volume), "trade_date": trade_date, "name": name, "cached": None}
 
-    print(f"\n✅ 完成！成功: {len(results)} / {total}")
+def analyze_chunk(chunk, trade_dates):
+    """
+    一批股票合并请求 Qwen；批量请求成功但回复中缺失的股票单独补分析。已带 analysis 的缓存结果直接跳过，
+    新结果按 trade_dates 中的交易日写入结果缓存
+    """
+    pending = [data for data in chunk if "analysis" not in data]
+    if pending:
+        print(f"🤖 AI 批量分析 {pending[0]['symbol']} 等 {len(pending)} 只...")
+        analyses = generate_analysis_batch(pending)
+        for data in pending:
+            data["analysis"] = analyses.get(data["symbol"]) or generate_analysis(data)
+            save_cached_result(data, trade_dates.get(data["symbol"]))
+    return chunk
+
+def main():
+    os.makedirs("output", exist_ok=True)
+    symbols = load_stock_list()
+    total = len(symbols)
+    print(f"🚀 开始分析 {total} 只股票（行情 {MAX_WORKERS} 线程 / AI {LLM_WORKERS} 线程并发）...\n")
+
+    generated_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    # 流水线：行情线程池持续拉取日线，每凑满一批即计算指标并交给 AI 线程池，
+    # 行情获取与 AI 分析同时进行；结果按 STOCKS.txt 顺序边完成边写入。
+    # 名称表在独立线程中与日线同时获取，不阻塞行情线程池启动
+    with ThreadPoolExecutor(max_workers=1) as bulk_pool, \
+            ThreadPoolExecutor(max_workers=MAX_WORKERS) as fetch_pool, \
+            ThreadPoolExecutor(max_workers=LLM_WORKERS) as llm_pool, \
+            PredictionWriter("output/predictions.json", generated_at) as writer:
+        name_map_future = bulk_pool.submit(load_name_map)
+        fetches = [(s, fetch_pool.submit(process_one, s, name_map_future)) for s in symbols]
+        # 按实际完成顺序显示进度（回调在工作线程中执行，itertools.count 取值线程安全）
+        fetched = itertools.count(1)
+        for symbol, future in fetches:
+            future.add_done_callback(lambda _, s=symbol: print(f"[{next(fetched)}/{total}] 已获取 {s}"))
+        ready = []
+        analyses = deque()
+
+        def submit_batch():
+            # 命中缓存的股票原样保留位置，只对其余股票计算指标并送 AI 分析
+            fresh = [(s, entry) for s, entry in ready if entry["cached"] is None]
+            features = iter(compute_features([s for s, _ in fresh], [entry["series"] for _, entry in fresh]))
+            chunk = []
+            for _, entry in ready:
+                if entry["cached"] is not None:
+                    chunk.append(entry["cached"])
+                else:
+                    data = next(features)
+                    data["name"] = entry["name"]
+                    chunk.append(data)
+            trade_dates = {s: entry["trade_date"] for s, entry in fresh}
+            analyses.append(llm_pool.submit(analyze_chunk, chunk, trade_dates))
+            ready.clear()
+
+        def drain(block):
+            # 单批异常只跳过该批股票，不中断整个运行
+            while analyses and (block or analyses[0].done()):
+                try:
+                    chunk = analyses.popleft().result()
+                except Exception as e:
+                    print(f"  ❌ AI 批量分析异常: {e}")
+                    continue
+                for data in chunk:
+                    writer.write(data)
+
+        for symbol, future in fetches:
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"  ❌ {symbol} 异常: {e}")
+                continue
+            if result is not None:
+                ready.append((symbol, result))
+            # 只按需要 AI 分析的股票数凑批，缓存命中不占批量名额
+            if sum(entry["cached"] is None for _, entry in ready) == BATCH_SIZE:
+                submit_batch()
+                drain(block=False)
+        if ready:
+            submit_batch()
+        drain(block=True)
+
+    save_name_cache()
+
+    print(f"\n✅ 完成！成功: {writer.count} / {total}")
     print("结果已保存至 output/predictions.json")
 
 if __name__ == "__main__":
@@ -0,0 +1,62 @@
+# 技术指标计算内核（Numba JIT），供 analyze_stocks.py 使用
+import os
+
+import numpy as np
+
+# Numba 编译缓存放在项目目录，CI 可跨运行复用，避免每次重新 JIT
+os.environ.setdefault("NUMBA_CACHE_DIR", os.path.abspath(".numba_cache"))
+
+try:
+    from numba import njit
+except ImportError:  # 未安装 numba 时退化为纯 Python 循环，结果一致
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+@njit(cache=True, fastmath=True)
+def calculate_rsi(arr, window=14):
+    """
+    Wilder RSI（RMA 平滑，与 TradingView 一致），单次遍历只返回最后一个值
+    """
+    n = arr.shape[0]
+    if n <= window:
+        return np.nan
+
+    # 前 window 个差分的简单均值作为初始值
+    avg_gain = 0.0
+    avg_loss = 0.0
+    for i in range(1, window + 1):
+        delta = arr[i] - arr[i - 1]
+        if delta > 0:
+            avg_gain += delta
+        else:
+            avg_loss -= delta
+    avg_gain /= window
+    avg_loss /= window
+
+    # 之后按 Wilder 递推：avg = (avg * (window - 1) + x) / window
+    for i in range(window + 1, n):
+        delta = arr[i] - arr[i - 1]
+        gain = delta if delta > 0 else 0.0
+        loss = -delta if delta < 0 else 0.0
+        avg_gain = (avg_gain * (window - 1) + gain) / window
+        avg_loss = (avg_loss * (window - 1) + loss) / window
+
+    if avg_loss == 0.0:
+        return 100.0
+    return 100.0 - 100.0 / (1.0 + avg_gain / avg_loss)
+
+@njit(cache=True)
+def calculate_rsi_rows(closes, lengths, window=14):
+    """
+    逐行计算 RSI：closes 为右对齐、左侧以 NaN 填充的 (股票数, 天数) 矩阵
+    """
+    n, width = closes.shape
+    out = np.empty(n)
+    for i in range(n):
+        out[i] = calculate_rsi(closes[i, width - lengths[i]:], window)
+    return out
+
+# 导入时预编译 JIT 内核（命中磁盘缓存时几乎无开销），避免编译耗时落在首只股票上
+calculate_rsi_rows(np.arange(40, dtype=np.float64).reshape(2, 20), np.array([20, 20]), 14)